@@ -1,3 +1,13 @@
 NOISE_KEYS = ["seed", "noise_seed"]
 
-IMAGE_EXTENSIONS = [".png", ".jpg", ".jpeg"]
\ No newline at end of file
+IMAGE_EXTENSIONS = [".png", ".jpg", ".jpeg"]
+
+RUNPOD_HTTP_TIMEOUT = 30.0
+
+WORKFLOW_TEMPLATE_DOWNLOAD_TIMEOUT = 10.0
+
+COMFY_HTTP_MAX_CONNECTIONS = 128
+
+COMFY_HTTP_MAX_KEEPALIVE_CONNECTIONS = 64
+
+COMFY_HTTP_CONNECT_TIMEOUT = 5.0
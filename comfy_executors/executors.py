@@ -1,22 +1,27 @@
 from contextlib import asynccontextmanager
-from copy import deepcopy
 import math
 import asyncio
 import random
 from typing import AsyncIterable, AsyncIterator, Generator, Iterable
-import uuid
 import abc
-import time
 import json
+import time
 
 from dataclasses import dataclass
 from PIL import Image as ImageFactory
 from PIL.Image import Image
 from pathlib import Path
-from threading import Thread
-from comfy_api_client import ComfyAPIClient, create_client as create_comfy_client
-from comfy_api_client.utils import randomize_noise_seeds
+import httpx
+import orjson
+from comfy_api_client import ComfyAPIClient
+from comfy_api_client.client import create_comfy_state_tracker
 from comfy_executors import utils
+from comfy_executors.constants import (
+    COMFY_HTTP_CONNECT_TIMEOUT,
+    COMFY_HTTP_MAX_CONNECTIONS,
+    COMFY_HTTP_MAX_KEEPALIVE_CONNECTIONS,
+    RUNPOD_HTTP_TIMEOUT,
+)
 from comfy_executors.mixins import LoggingMixin
 from comfy_executors.workflows import WorkflowTemplate
 
@@ -63,6 +68,9 @@ class RunPodWorkflowExecutor(BaseWorkflowExecutor, LoggingMixin):
         endpoint_id: str,
         batch_size: int = 1,
         comfyui_base_dir: str = "/comfyui",
+        input_image_format: str = "png",
+        input_image_options: dict | None = None,
+        http_client: httpx.AsyncClient | None = None,
     ):
         try:
             from runpod import Endpoint
@@ -74,6 +82,16 @@ class RunPodWorkflowExecutor(BaseWorkflowExecutor, LoggingMixin):
         self.endpoint = Endpoint(endpoint_id)
         self.batch_size = batch_size
         self.comfyui_base_dir = Path(comfyui_base_dir)
+        self._input_root = str(self.comfyui_base_dir / "input")
+        # RunPod only accepts JSON payloads, so input images have to be sent base64
+        # encoded. Lossy formats like "webp" or "jpeg" considerably reduce the
+        # payload size compared to the default lossless "png".
+        self.input_image_format = input_image_format.lower()
+        # Additional options passed to Image.save, e.g. {"quality": 90}
+        self.input_image_options = input_image_options or {}
+        # Client used by submit_workflow_async. If not given, a new client is created
+        # for every submission.
+        self.http_client = http_client
 
     def _prepare_workflow_payload(
         self,
@@ -83,12 +101,12 @@ class RunPodWorkflowExecutor(BaseWorkflowExecutor, LoggingMixin):
         randomize_seed: bool = True,
         **kwargs,
     ):
-        # This is not the RunPod job ID but just a random ID to group the input
+        # This is not the RunPod job ID but just a unique ID to group the input
         # images within the ComfyUI input folder.
-        job_id = uuid.uuid4().hex
+        job_id = utils.generate_job_id()
 
         input_images = input_images or []
-        input_images_dir = self.comfyui_base_dir / "input" / job_id
+        input_images_dir = f"{self._input_root}/{job_id}"
 
         batch_size = kwargs.get("batch_size", self.batch_size)
 
@@ -109,31 +127,86 @@ class RunPodWorkflowExecutor(BaseWorkflowExecutor, LoggingMixin):
                 "randomize_seed": randomize_seed,
                 "images": [
                     {
-                        "name": f"{i:02d}.png",
-                        "image": utils.image_to_b64(image, format="png"),
+                        "name": f"{i:02d}.{self.input_image_format}",
+                        "image": image_b64,
                         "subfolder": job_id,
                     }
-                    for i, image in enumerate(input_images)
+                    for i, image_b64 in enumerate(
+                        utils.images_to_b64(
+                            input_images,
+                            format=self.input_image_format,
+                            **self.input_image_options,
+                        )
+                    )
                 ],
             }
         }
 
         return payload
 
-    def _merge_chunks(self, stream):
-        # The worker returns JSON lines objects but in chunks. We need to combine the
-        # chunks into lines and then parse the JSON.
-        chunks = []
+    def _parse_output(self, output: bytes, ignore_errors: bool = False):
+        if not output.strip():
+            return []
 
-        for chunk in stream:
-            if chunk.endswith("\n"):
-                chunks.append(chunk[:-1])
-                yield "".join(chunks)
-                chunks = []
-            else:
-                chunks.append(chunk)
+        self.logger.debug(f"Payload size: {len(output)}")
+
+        output = orjson.loads(output)
+
+        if not output:
+            return []
+
+        if (error := output.get("error")) is not None and not ignore_errors:
+            raise WorkflowError(error)
+
+        # Decode all images of a line in the background so the remaining images are
+        # ready by the time the consumer asks for them. Image.open only parses the
+        # header; pixel data is decoded lazily on first access by the consumer.
+        pool = utils.get_thread_pool()
+
+        return [
+            (pool.submit(utils.image_from_b64, image_item["image"]), image_item)
+            for image_item in output.get("images", ())
+        ]
+
+    @staticmethod
+    def _serialize_payload(payload: dict) -> bytes:
+        # Non-finite floats are rejected as before, when requests serialized the payload
+        # with allow_nan=False; orjson would silently write them as null. orjson also
+        # rejects integers beyond 64 bits, so fall back to the json module for those.
+        utils.check_finite_floats(payload)
+
+        try:
+            return orjson.dumps(payload)
+        except TypeError:
+            return json.dumps(payload, allow_nan=False).encode()
+
+    @staticmethod
+    def _raise_for_status(response):
+        from runpod.endpoint.helpers import UNAUTHORIZED_MSG
+
+        # Same error as the RunPod SDK raises for an invalid API key
+        if response.status_code == 401:
+            raise RuntimeError(UNAUTHORIZED_MSG)
+
+        response.raise_for_status()
+
+    def _run_job(self, payload: dict):
+        from runpod.endpoint.runner import Job
+
+        # Equivalent to self.endpoint.run(payload) but serializes the (potentially
+        # large) payload with orjson instead of letting requests use the json module.
+        # The session, headers and base URL are the public attributes of the SDK's
+        # RunPodClient that Endpoint.run uses as well.
+        rp_client = self.endpoint.rp_client
+        response = rp_client.rp_session.post(
+            self._get_endpoint_url("run"),
+            data=self._serialize_payload(payload),
+            headers=rp_client.headers,
+            timeout=RUNPOD_HTTP_TIMEOUT,
+        )
+        self._raise_for_status(response)
 
-        assert not chunks, "The last chunk should be empty. If not, the worker did not send a newline character at the end of the last line."
+        return Job(self.endpoint.endpoint_id, response.json()["id"], rp_client)
 
     def submit_workflow(
         self,
@@ -144,7 +217,7 @@ class RunPodWorkflowExecutor(BaseWorkflowExecutor, LoggingMixin):
         ignore_errors: bool = False,
         **kwargs,
     ) -> Iterable[WorkflowOutputImage]:
-        job = self.endpoint.run(
+        job = self._run_job(
             self._prepare_workflow_payload(
                 workflow_template=workflow_template,
                 input_images=input_images,
@@ -154,31 +227,27 @@ class RunPodWorkflowExecutor(BaseWorkflowExecutor, LoggingMixin):
             )
         )
 
+        # Poll quickly at first so short queue times add little latency, but back off
+        # for jobs that are queued for a long time.
+        delays = utils.backoff_delays()
+
         while (status := job.status()) == "IN_QUEUE":
             self.logger.debug(
                 f"Job {job.job_id} is in queue. Waiting for it to start..."
             )
-            time.sleep(1)
+            time.sleep(next(delays))
 
         if status == "FAILED":
             raise WorkflowError(job.output())
 
         self.logger.debug(f"Job {job.job_id} has started. Streaming output...")
 
-        for output in self._merge_chunks(job.stream()):
-            self.logger.debug(f"Payload size: {len(output)}")
-
-            output = json.loads(output)
-
-            if not output:
-                continue
-
-            if "error" in output and not ignore_errors:
-                raise WorkflowError(output["error"])
-
-            for image_item in output["images"]:
+        for output in utils.merge_chunks(job.stream()):
+            for image, image_item in self._parse_output(
+                output, ignore_errors=ignore_errors
+            ):
                 yield WorkflowOutputImage(
-                    image=utils.image_from_b64(image_item["image"]),
+                    image=image.result(),
                     name=image_item["name"],
                     subfolder=image_item["subfolder"],
                 )
@@ -187,6 +256,44 @@ class RunPodWorkflowExecutor(BaseWorkflowExecutor, LoggingMixin):
 
         assert job.status() == "COMPLETED"
 
+    def _get_endpoint_url(self, path: str):
+        rp_client = self.endpoint.rp_client
+        return f"{rp_client.endpoint_url_base}/{self.endpoint.endpoint_id}/{path}"
+
+    @asynccontextmanager
+    async def _create_http_client(self):
+        if self.http_client is not None:
+            yield self.http_client
+        else:
+            async with httpx.AsyncClient(timeout=RUNPOD_HTTP_TIMEOUT) as client:
+                yield client
+
+    async def _fetch_job_async(
+        self, client: httpx.AsyncClient, job_id: str, source: str = "status"
+    ) -> dict:
+        response = await client.get(
+            self._get_endpoint_url(f"{source}/{job_id}"),
+            headers=self.endpoint.rp_client.headers,
+        )
+        self._raise_for_status(response)
+        return response.json()
+
+    async def _stream_job_async(self, client: httpx.AsyncClient, job_id: str):
+        from runpod.endpoint.helpers import is_completed
+
+        # Mirrors runpod.endpoint.runner.Job.stream but without blocking the event loop.
+        while True:
+            await asyncio.sleep(1)
+
+            job_state = await self._fetch_job_async(client, job_id, source="stream")
+            stream = job_state.get("stream", [])
+
+            if not is_completed(job_state["status"]) or stream:
+                for chunk in stream:
+                    yield chunk["output"]
+            else:
+                break
+
     async def submit_workflow_async(
         self,
         workflow_template: WorkflowTemplate,
@@ -195,37 +302,99 @@ class RunPodWorkflowExecutor(BaseWorkflowExecutor, LoggingMixin):
         randomize_seed: bool = True,
         ignore_errors: bool = False,
         **kwargs,
-    ) -> AsyncIterable[WorkflowOutputImage]:
-        loop = asyncio.get_running_loop()
+    ) -> AsyncIterator[WorkflowOutputImage]:
+        # The payload is prepared in a worker thread. The input images are only read
+        # there, so a shallow copy suffices to guard against the list being modified
+        # concurrently; the images themselves must not be modified until this
+        # generator has produced its first output.
+        input_images = list(input_images or [])
+
+        payload = await asyncio.to_thread(
+            self._prepare_workflow_payload,
+            workflow_template=workflow_template,
+            input_images=input_images,
+            num_samples=num_samples,
+            randomize_seed=randomize_seed,
+            **kwargs,
+        )
 
-        input_images = deepcopy(input_images)
+        async with self._create_http_client() as client:
+            response = await client.post(
+                self._get_endpoint_url("run"),
+                content=self._serialize_payload(payload),
+                headers=self.endpoint.rp_client.headers,
+            )
+            self._raise_for_status(response)
 
-        future = loop.create_future()
+            job_id = response.json()["id"]
 
-        def handler():
-            images = []
+            delays = utils.backoff_delays()
+            job_state = await self._fetch_job_async(client, job_id)
 
-            try:
-                for image in self.submit_workflow(
-                    workflow_template=workflow_template,
-                    input_images=input_images,
-                    num_samples=num_samples,
-                    randomize_seed=randomize_seed,
-                    ignore_errors=ignore_errors,
-                    **kwargs,
-                ):
-                    images.append(image)
+            while job_state["status"] == "IN_QUEUE":
+                self.logger.debug(
+                    f"Job {job_id} is in queue. Waiting for it to start..."
+                )
+                await asyncio.sleep(next(delays))
+                job_state = await self._fetch_job_async(client, job_id)
 
-                loop.call_soon_threadsafe(future.set_result, images)
-            except KeyboardInterrupt:
-                print("Keyboard interrupt received. Cancelling job...")
-            except Exception as e:
-                loop.call_soon_threadsafe(future.set_exception, e)
+            if job_state["status"] == "FAILED":
+                raise WorkflowError(job_state.get("output"))
 
-        thread = Thread(target=handler)
-        thread.start()
+            self.logger.debug(f"Job {job_id} has started. Streaming output...")
 
-        return await future
+            async for output in utils.merge_chunks_async(
+                self._stream_job_async(client, job_id)
+            ):
+                for image, image_item in self._parse_output(
+                    output, ignore_errors=ignore_errors
+                ):
+                    # Wait for the decoding without blocking the event loop
+                    yield WorkflowOutputImage(
+                        image=await asyncio.wrap_future(image),
+                        name=image_item["name"],
+                        subfolder=image_item["subfolder"],
+                    )
+
+            self.logger.debug(f"Stream for job {job_id} has ended.")
+
+            job_state = await self._fetch_job_async(client, job_id)
+
+            assert job_state["status"] == "COMPLETED"
+
+
+@asynccontextmanager
+async def create_comfy_client(
+    comfy_url: str,
+    http_timeout: float | None = 30.0,
+    start_state_tracker: str | None = "websocket",
+    state_tracker_kwargs: dict | None = None,
+):
+    # Same as comfy_api_client.create_client but with a connection pool sized for
+    # bursts of concurrent uploads and HTTP/2 multiplexing if h2 is installed.
+    async with httpx.AsyncClient(
+        http2=utils.is_http2_available(),
+        limits=httpx.Limits(
+            max_connections=COMFY_HTTP_MAX_CONNECTIONS,
+            max_keepalive_connections=COMFY_HTTP_MAX_KEEPALIVE_CONNECTIONS,
+        ),
+        timeout=httpx.Timeout(http_timeout, connect=COMFY_HTTP_CONNECT_TIMEOUT),
+    ) as http_client:
+        comfy_client = ComfyAPIClient(comfy_url, http_client)
+
+        await comfy_client.get_index()
+
+        if start_state_tracker is not None:
+            await create_comfy_state_tracker(
+                comfy_client, start_state_tracker, **(state_tracker_kwargs or {})
+            )
+
+        try:
+            yield comfy_client
+        finally:
+            # stop() removes the tracker from the list
+            for state_tracker in list(comfy_client.state_trackers):
+                await state_tracker.stop()
 
 
 class ComfyServerWorkflowExecutor(BaseWorkflowExecutor, LoggingMixin):
@@ -234,10 +403,18 @@ class ComfyServerWorkflowExecutor(BaseWorkflowExecutor, LoggingMixin):
         comfy_client: ComfyAPIClient,
         batch_size: int = 1,
         input_base_dir: str = "input",
+        upload_concurrency: int = 16,
     ):
         self.comfy_client = comfy_client
         self.batch_size = batch_size
         self.input_base_dir = input_base_dir
+        self._input_root = str(Path(input_base_dir))
+        self.upload_concurrency = upload_concurrency
+
+        try:
+            self.loop = asyncio.get_running_loop()
+        except RuntimeError:
+            self.loop = None
 
     @classmethod
     @asynccontextmanager
@@ -246,6 +423,7 @@ class ComfyServerWorkflowExecutor(BaseWorkflowExecutor, LoggingMixin):
         comfy_host: str,
         batch_size: int = 1,
         input_base_dir: str = "input",
+        upload_concurrency: int = 16,
         **comfy_client_kwargs,
     ):
         async with create_comfy_client(
@@ -255,6 +433,7 @@ class ComfyServerWorkflowExecutor(BaseWorkflowExecutor, LoggingMixin):
                 comfy_client=comfy_client,
                 batch_size=batch_size,
                 input_base_dir=input_base_dir,
+                upload_concurrency=upload_concurrency,
             )
 
     def submit_workflow(
@@ -265,18 +444,18 @@ class ComfyServerWorkflowExecutor(BaseWorkflowExecutor, LoggingMixin):
         randomize_seed: bool = True,
         **kwargs,
     ) -> Iterable[WorkflowOutputImage]:
-        loop = asyncio.get_event_loop()
-        yield from list(
-            loop.run_until_complete(
-                self.submit_workflow_async(
-                    workflow_template=workflow_template,
-                    input_images=input_images,
-                    num_samples=num_samples,
-                    randomize_seed=randomize_seed,
-                    loop=loop,
-                    **kwargs,
-                )
-            )
+        # The client is bound to the event loop it was created in.
+        loop = self.loop or asyncio.get_event_loop()
+
+        yield from utils.iterate_in_loop(
+            self.submit_workflow_async(
+                workflow_template=workflow_template,
+                input_images=input_images,
+                num_samples=num_samples,
+                randomize_seed=randomize_seed,
+                **kwargs,
+            ),
+            loop,
         )
 
     async def submit_workflow_async(
@@ -288,29 +467,34 @@ class ComfyServerWorkflowExecutor(BaseWorkflowExecutor, LoggingMixin):
         ignore_errors: bool = False,
         **kwargs,
     ) -> AsyncIterable[WorkflowOutputImage]:
-        job_id = uuid.uuid4().hex
+        job_id = utils.generate_job_id()
 
         input_images = input_images or []
 
-        uploads = [
-            asyncio.create_task(
-                self.comfy_client.upload_image(f"{i:04d}.jpg", image, subfolder=job_id)
-            )
-            for i, image in enumerate(input_images)
-        ]
+        # Limit the number of simultaneous uploads to not overwhelm the server with
+        # large multipart requests.
+        upload_semaphore = asyncio.Semaphore(self.upload_concurrency)
 
-        self.logger.info(f"Uploading {len(uploads)} images for job {job_id}...")
+        async def upload_image(i, image):
+            async with upload_semaphore:
+                return await self.comfy_client.upload_image(
+                    f"{i:04d}.jpg", image, subfolder=job_id
+                )
 
-        await asyncio.gather(*uploads)
+        self.logger.info(f"Uploading {len(input_images)} images for job {job_id}...")
+
+        await asyncio.gather(
+            *(upload_image(i, image) for i, image in enumerate(input_images))
+        )
 
         self.logger.info(f"Images uploaded for job {job_id}. Submitting workflow...")
 
         batch_size = kwargs.setdefault("batch_size", self.batch_size)
 
-        input_images_dir = Path(self.input_base_dir) / job_id
+        input_images_dir = f"{self._input_root}/{job_id}"
 
         workflow = workflow_template.render(
-            input_images_dir=str(input_images_dir),
+            input_images_dir=input_images_dir,
             **kwargs,
         )
 
@@ -319,13 +503,17 @@ class ComfyServerWorkflowExecutor(BaseWorkflowExecutor, LoggingMixin):
         else:
             batch_count = kwargs.get("batch_count", 1)
 
+        noise_seed_paths = utils.find_noise_seed_paths(workflow)
+
         prompts = []
 
         for _ in range(batch_count):
             submit_workflow = workflow
 
             if randomize_seed:
-                submit_workflow = randomize_noise_seeds(submit_workflow)
+                submit_workflow = utils.randomize_noise_seeds(
+                    submit_workflow, noise_seed_paths
+                )
 
             prompts.append(
                 asyncio.create_task(self.comfy_client.submit_workflow(submit_workflow))
@@ -335,29 +523,48 @@ class ComfyServerWorkflowExecutor(BaseWorkflowExecutor, LoggingMixin):
 
         futures = [result.future for result in await asyncio.gather(*prompts)]
 
-        for i, future in enumerate(futures):
-            try:
-                result = await future
-            except Exception as e:
-                if ignore_errors:
-                    self.logger.error(
-                        f"Got error for batch {i + 1}/{batch_count} of job {job_id}: {e}"
-                    )
-                    continue
-                else:
-                    raise
+        async def wait_for_batch(i, future):
+            await asyncio.wait([future])
+            return i, future
 
-            self.logger.info(
-                f"Got results for batch {i + 1}/{batch_count} of job {job_id}"
-            )
+        waiters = [
+            asyncio.ensure_future(wait_for_batch(i, future))
+            for i, future in enumerate(futures)
+        ]
 
-            for image_item in result.output_images:
-                yield WorkflowOutputImage(
-                    image=image_item.image,
-                    name=image_item.filename,
-                    subfolder=None,
+        # Yield batches in the order in which they complete rather than in the order
+        # in which they were submitted.
+        try:
+            for batch in asyncio.as_completed(waiters):
+                i, future = await batch
+
+                try:
+                    result = future.result()
+                except Exception as e:
+                    if ignore_errors:
+                        self.logger.error(
+                            f"Got error for batch {i + 1}/{batch_count} of job {job_id}: {e}"
+                        )
+                        continue
+                    else:
+                        raise
+
+                self.logger.info(
+                    f"Got results for batch {i + 1}/{batch_count} of job {job_id}"
                 )
 
+                for image_item in result.output_images:
+                    yield WorkflowOutputImage(
+                        image=image_item.image,
+                        name=image_item.filename,
+                        subfolder=None,
+                    )
+        finally:
+            # Do not leave waiters pending if a batch failed or the consumer stopped
+            # early.
+            for waiter in waiters:
+                waiter.cancel()
+
 
 class ModalWorkflowExecutor(BaseWorkflowExecutor, LoggingMixin):
     def __init__(
@@ -374,6 +581,7 @@ class ModalWorkflowExecutor(BaseWorkflowExecutor, LoggingMixin):
         self.modal_app = modal_app
         self.modal_class_name = modal_class_name
         self.comfy_root = comfy_root
+        self._input_root = str(Path(comfy_root) / "input")
         self.batch_size = batch_size
 
     def get_comfy_modal_instance(self):
@@ -407,11 +615,15 @@ class ModalWorkflowExecutor(BaseWorkflowExecutor, LoggingMixin):
         else:
             batch_count = kwargs.get("batch_count", 1)
 
+        noise_seed_paths = utils.find_noise_seed_paths(workflow)
+
         for _ in range(batch_count):
             curr_workflow = workflow
 
             if randomize_seed:
-                curr_workflow = randomize_noise_seeds(curr_workflow)
+                curr_workflow = utils.randomize_noise_seeds(
+                    curr_workflow, noise_seed_paths
+                )
 
             yield curr_workflow
 
@@ -425,10 +637,10 @@ class ModalWorkflowExecutor(BaseWorkflowExecutor, LoggingMixin):
     ) -> Iterable[WorkflowOutputImage]:
         comfy = self.get_comfy_modal_instance()
 
-        job_id = uuid.uuid4().hex
+        job_id = utils.generate_job_id()
 
         input_images = input_images or []
-        input_images_dir = str(Path(self.comfy_root) / "input" / job_id)
+        input_images_dir = f"{self._input_root}/{job_id}"
         input_images_dict = {
             f"{i:04d}.jpg": image for i, image in enumerate(input_images)
         }
@@ -469,10 +681,10 @@ class ModalWorkflowExecutor(BaseWorkflowExecutor, LoggingMixin):
 
         comfy = self.get_comfy_modal_instance()
 
-        job_id = uuid.uuid4().hex
+        job_id = utils.generate_job_id()
 
         input_images = input_images or []
-        input_images_dir = str(Path(self.comfy_root) / "input" / job_id)
+        input_images_dir = f"{self._input_root}/{job_id}"
         input_images_dict = {
             f"{i:04d}.jpg": image for i, image in enumerate(input_images)
         }
@@ -521,9 +733,9 @@ class DummyWorkflowExecutor(BaseWorkflowExecutor):
             self.images = [self.create_dummy_image()]
 
     def create_dummy_image(self):
-        image = ImageFactory.new("RGB", (self.image_size, self.image_size))
-        image.paste(self.fallback_fill_color, (0, 0, image.width, image.height))
-        return image
+        return utils.create_solid_image(
+            (self.image_size, self.image_size), tuple(self.fallback_fill_color)
+        )
 
     def submit_workflow(
         self,
@@ -1,32 +1,259 @@
 import io
-import base64
+import os
+import math
+import uuid
+import asyncio
+import random
+import itertools
+import importlib.util
 
+from concurrent.futures import ThreadPoolExecutor
+from functools import cache, lru_cache, partial
 from pathlib import Path
+from typing import AsyncIterable, AsyncIterator, Iterable, Iterator
 from PIL import Image as ImageFactory
 from PIL.Image import Image
 
-from comfy_executors.constants import IMAGE_EXTENSIONS
+from comfy_executors.constants import IMAGE_EXTENSIONS, NOISE_KEYS
 
+try:
+    # SIMD accelerated drop-in replacement for the standard library implementation
+    from pybase64 import b64decode, b64encode
+except ImportError:
+    from base64 import b64decode, b64encode
 
-def image_to_buffer(image: Image, format="jpeg"):
+
+def image_to_buffer(image: Image, format="jpeg", **kwargs):
     buffer = io.BytesIO()
-    image.save(buffer, format=format)
+    image.save(buffer, format=format, **kwargs)
     buffer.seek(0)
     return buffer
 
 
-def image_to_b64(image: Image, format="jpeg"):
-    buffer = image_to_buffer(image, format=format)
-    image_b64 = base64.b64encode(buffer.getvalue()).decode("utf8")
-    return image_b64
+def image_to_b64(image: Image, format="jpeg", **kwargs):
+    buffer = image_to_buffer(image, format=format, **kwargs)
+
+    # Encode straight from the buffer's memory instead of copying it out first.
+    with buffer.getbuffer() as image_bytes:
+        image_b64 = b64encode(image_bytes)
+
+    return image_b64.decode("utf8")
+
+
+@cache
+def get_thread_pool() -> ThreadPoolExecutor:
+    # Pillow releases the GIL while encoding and decoding, so a thread pool
+    # parallelizes image (de)serialization without pickling pixel data to worker
+    # processes.
+    return ThreadPoolExecutor(
+        max_workers=os.cpu_count(), thread_name_prefix="comfy-executors"
+    )
+
+
+# A forked child inherits the pool but not its worker threads, so work submitted to
+# it would never run. os.register_at_fork is only available on POSIX systems.
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=get_thread_pool.cache_clear)
+
+
+def images_to_b64(images: list[Image], format="jpeg", **kwargs):
+    if len(images) <= 1:
+        return [image_to_b64(image, format=format, **kwargs) for image in images]
+
+    encode = partial(image_to_b64, format=format, **kwargs)
+    return list(get_thread_pool().map(encode, images))
 
 
 def image_from_b64(image_b64: str):
-    image_bytes = base64.b64decode(image_b64)
+    image_bytes = b64decode(image_b64)
     image = ImageFactory.open(io.BytesIO(image_bytes))
     return image
 
 
+def _pop_lines(buffer: bytearray, scan_from: int = 0):
+    # Lines are copied out of the buffer exactly once and the consumed prefix is
+    # removed with a single deletion instead of shifting the buffer for every line.
+    # The buffer holds no newline before scan_from, so the partial line carried
+    # over from previous chunks is not scanned again.
+    start = 0
+
+    with memoryview(buffer) as view:
+        while (index := buffer.find(b"\n", max(start, scan_from))) != -1:
+            yield view[start:index].tobytes()
+            start = index + 1
+
+    del buffer[:start]
+
+
+def _extend_buffer(buffer: bytearray, chunk: str | bytes) -> int:
+    scan_from = len(buffer)
+    buffer.extend(chunk.encode("utf8") if isinstance(chunk, str) else chunk)
+    return scan_from
+
+
+def merge_chunks(chunks: Iterable[str | bytes]) -> Iterator[bytes]:
+    # Combines chunks of a JSON lines stream into complete lines. Chunk boundaries
+    # need not align with line boundaries.
+    buffer = bytearray()
+
+    for chunk in chunks:
+        scan_from = _extend_buffer(buffer, chunk)
+        yield from _pop_lines(buffer, scan_from)
+
+    assert not buffer, "The stream did not end with a newline character."
+
+
+async def merge_chunks_async(
+    chunks: AsyncIterable[str | bytes],
+) -> AsyncIterator[bytes]:
+    buffer = bytearray()
+
+    async for chunk in chunks:
+        scan_from = _extend_buffer(buffer, chunk)
+        for line in _pop_lines(buffer, scan_from):
+            yield line
+
+    assert not buffer, "The stream did not end with a newline character."
+
+
+def iterate_in_loop(
+    async_iterator: AsyncIterator, loop: asyncio.AbstractEventLoop
+) -> Iterator:
+    # Consumes an async iterator from synchronous code, one item at a time. If the
+    # loop is running in another thread, the items are retrieved there, otherwise
+    # the loop is run until the next item is available.
+    stop = object()
+
+    async def next_item():
+        try:
+            return await anext(async_iterator)
+        except StopAsyncIteration:
+            return stop
+
+    if loop.is_running():
+        try:
+            running_loop = asyncio.get_running_loop()
+        except RuntimeError:
+            running_loop = None
+
+        if running_loop is loop:
+            raise RuntimeError(
+                "Cannot iterate synchronously within the running event loop. "
+                "Use the asynchronous API instead."
+            )
+
+        def run(coro):
+            return asyncio.run_coroutine_threadsafe(coro, loop).result()
+    else:
+        run = loop.run_until_complete
+
+    try:
+        while (item := run(next_item())) is not stop:
+            yield item
+    finally:
+        run(async_iterator.aclose())
+
+
+def backoff_delays(initial=0.1, factor=1.5, maximum=2.0):
+    delay = initial
+    while True:
+        yield delay
+        delay = min(delay * factor, maximum)
+
+
+@cache
+def is_http2_available():
+    return importlib.util.find_spec("h2") is not None
+
+
+def check_finite_floats(obj):
+    # Raises like json.dumps(obj, allow_nan=False), which orjson has no option for.
+    if isinstance(obj, float):
+        if not math.isfinite(obj):
+            raise ValueError(f"Out of range float values are not JSON compliant: {obj}")
+    elif isinstance(obj, dict):
+        for value in obj.values():
+            check_finite_floats(value)
+    elif isinstance(obj, (list, tuple)):
+        for value in obj:
+            check_finite_floats(value)
+
+
+def find_noise_seed_paths(
+    workflow: dict, noise_keys: list[str] | None = None, path: tuple = ()
+) -> list[tuple]:
+    # Locates the same values as comfy_api_client.utils.replace_noise_seeds, i.e.
+    # the noise keys within any "inputs" mapping, so that seeds can be replaced
+    # repeatedly without walking the whole workflow again.
+    if noise_keys is None:
+        noise_keys = NOISE_KEYS
+
+    paths = []
+
+    for key, value in workflow.items():
+        if not isinstance(value, dict):
+            continue
+
+        if key == "inputs":
+            paths.extend(
+                (*path, key, noise_key)
+                for noise_key in noise_keys
+                if noise_key in value
+            )
+        else:
+            paths.extend(find_noise_seed_paths(value, noise_keys, (*path, key)))
+
+    return paths
+
+
+def replace_noise_seeds(workflow: dict, seed: int, noise_seed_paths: list[tuple]):
+    # Only the dictionaries along the given paths are copied, all other values are
+    # shared with the original workflow.
+    workflow = dict(workflow)
+
+    for path in noise_seed_paths:
+        parent = workflow
+
+        for key in path[:-1]:
+            parent[key] = dict(parent[key])
+            parent = parent[key]
+
+        parent[path[-1]] = seed
+
+    return workflow
+
+
+def randomize_noise_seeds(workflow: dict, noise_seed_paths: list[tuple]):
+    seed = random.randint(0, 2**32 - 1)
+    return replace_noise_seeds(workflow, seed, noise_seed_paths)
+
+
+@lru_cache(maxsize=8)
+def create_solid_image(size: tuple[int, int], color: tuple[int, int, int]) -> Image:
+    # Shared between callers, the returned image must not be modified.
+    return ImageFactory.new("RGB", size, color)
+
+
+def _reset_job_ids():
+    global _job_id_prefix, _job_id_counter
+    _job_id_prefix = uuid.uuid4().hex[:16]
+    _job_id_counter = itertools.count()
+
+
+_reset_job_ids()
+
+# os.register_at_fork is only available on POSIX systems
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_reset_job_ids)
+
+
+def generate_job_id():
+    # Job IDs only need to be unique, not unpredictable. A random prefix per process
+    # keeps them unique across processes and hosts sharing a ComfyUI input folder
+    # without reading from the system's random source for every job.
+    return f"{_job_id_prefix}{next(_job_id_counter):016x}"
+
+
 def fullname(o):
     module = o.__class__.__module__
     if module is None or module == str.__class__.__module__:
@@ -34,10 +261,28 @@ def fullname(o):
     return module + "." + o.__class__.__name__
 
 
+def _scan_files(path, extensions: frozenset[str]):
+    # Like Path.glob, skip directories that are missing or cannot be listed.
+    try:
+        entries = os.scandir(path)
+    except OSError:
+        return
+
+    with entries:
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                yield from _scan_files(entry.path, extensions)
+            elif (
+                os.path.splitext(entry.name)[1].lower() in extensions
+                and entry.is_file()
+            ):
+                yield Path(entry.path)
+
+
 def glob_by_extensions(path, extensions):
-    path = Path(path)
-    for ext in extensions:
-        yield from path.glob(f"**/*{ext}")
+    # Walks the directory tree once, reusing the file type information from the
+    # directory listing, instead of globbing the tree once per extension.
+    yield from _scan_files(path, frozenset(ext.lower() for ext in extensions))
 
 
 def glob_images(path):
@@ -1,31 +1,51 @@
+import os
 import json
 import requests
 
-from jinja2 import Template, StrictUndefined, meta
+from functools import lru_cache
+from jinja2 import Environment, StrictUndefined, meta
+from comfy_executors.constants import WORKFLOW_TEMPLATE_DOWNLOAD_TIMEOUT
+
+
+_environment = Environment(undefined=StrictUndefined)
+
+# Shared session so that repeated template downloads reuse pooled connections
+_session = requests.Session()
 
 
 class WorkflowTemplate:
-    REQUIRED_VARIABLES = ["input_images_dir", "batch_size"]
+    REQUIRED_VARIABLES = frozenset({"input_images_dir", "batch_size"})
 
     def __init__(self, template_string: str):
-        self.workflow_template = Template(template_string, undefined=StrictUndefined)
-
-        ast = self.workflow_template.environment.parse(template_string)
+        # Parse once and compile the template from the same AST
+        ast = _environment.parse(template_string)
 
         undeclared_variables = meta.find_undeclared_variables(ast)
-        if undeclared_variables < set(self.REQUIRED_VARIABLES):
+        if not self.REQUIRED_VARIABLES <= undeclared_variables:
             raise ValueError(
-                f"Missing variables in workflow template: {set(self.REQUIRED_VARIABLES) - undeclared_variables}"
+                f"Missing variables in workflow template: {set(self.REQUIRED_VARIABLES - undeclared_variables)}"
             )
 
+        self.workflow_template = _environment.from_string(ast)
+
     @classmethod
     def from_file(cls, filename):
+        # Templates are immutable, so repeated loads of an unchanged file can share
+        # one instance.
+        filename = os.path.abspath(filename)
+        # The size catches rewrites within the timestamp resolution of the filesystem
+        stat = os.stat(filename)
+        return cls._from_file_cached(filename, stat.st_mtime_ns, stat.st_size)
+
+    @classmethod
+    @lru_cache(maxsize=32)
+    def _from_file_cached(cls, filename, mtime_ns, size):
         with open(filename) as f:
             return cls(f.read())
 
     @classmethod
     def from_url(cls, url):
-        response = requests.get(url)
+        response = _session.get(url, timeout=WORKFLOW_TEMPLATE_DOWNLOAD_TIMEOUT)
         response.raise_for_status()
         return cls(response.text)
 
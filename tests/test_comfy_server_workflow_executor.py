@@ -0,0 +1,122 @@
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+
+from comfy_executors import executors, utils
+from comfy_executors.executors import ComfyServerWorkflowExecutor
+from comfy_executors.workflows import WorkflowTemplate
+
+WORKFLOW_TEMPLATE = WorkflowTemplate(
+    '{"dir": "{{ input_images_dir }}", "batch_size": {{ batch_size }}}'
+)
+
+
+class StubComfyClient:
+    def __init__(self, resolve_workflows=True):
+        self.resolve_workflows = resolve_workflows
+        self.uploads = []
+        self.active_uploads = 0
+        self.max_active_uploads = 0
+        self.futures = []
+
+    async def upload_image(self, name, image, subfolder=None):
+        self.active_uploads += 1
+        self.max_active_uploads = max(self.max_active_uploads, self.active_uploads)
+        await asyncio.sleep(0.01)
+        self.active_uploads -= 1
+        self.uploads.append(name)
+
+    async def submit_workflow(self, workflow):
+        future = asyncio.get_running_loop().create_future()
+        self.futures.append(future)
+
+        if self.resolve_workflows:
+            future.set_result(SimpleNamespace(output_images=[]))
+
+        return SimpleNamespace(future=future)
+
+
+@pytest.mark.asyncio
+async def test_upload_concurrency():
+    comfy_client = StubComfyClient()
+    executor = ComfyServerWorkflowExecutor(comfy_client, upload_concurrency=3)
+    input_images = [utils.create_solid_image((8, 8), (0, 0, 0))] * 10
+
+    async for _ in executor.submit_workflow_async(WORKFLOW_TEMPLATE, input_images):
+        pass
+
+    assert comfy_client.max_active_uploads == 3
+    assert sorted(comfy_client.uploads) == [f"{i:04d}.jpg" for i in range(10)]
+
+
+@pytest.mark.asyncio
+async def test_batches_in_completion_order():
+    comfy_client = StubComfyClient(resolve_workflows=False)
+    executor = ComfyServerWorkflowExecutor(comfy_client)
+
+    outputs = executor.submit_workflow_async(WORKFLOW_TEMPLATE, num_samples=3)
+    next_output = asyncio.ensure_future(anext(outputs))
+
+    while len(comfy_client.futures) < 3:
+        await asyncio.sleep(0.01)
+
+    names = []
+
+    for i in [2, 0, 1]:
+        image_item = SimpleNamespace(image=None, filename=f"batch-{i}.png")
+        comfy_client.futures[i].set_result(SimpleNamespace(output_images=[image_item]))
+        names.append((await asyncio.wait_for(next_output, timeout=1)).name)
+        next_output = asyncio.ensure_future(anext(outputs, None))
+
+    assert names == ["batch-2.png", "batch-0.png", "batch-1.png"]
+    assert await next_output is None
+
+
+@pytest.mark.asyncio
+async def test_failed_batch_cancels_pending_batches():
+    comfy_client = StubComfyClient(resolve_workflows=False)
+    executor = ComfyServerWorkflowExecutor(comfy_client)
+
+    outputs = executor.submit_workflow_async(WORKFLOW_TEMPLATE, num_samples=3)
+    next_output = asyncio.ensure_future(anext(outputs))
+
+    while len(comfy_client.futures) < 3:
+        await asyncio.sleep(0.01)
+
+    comfy_client.futures[1].set_exception(RuntimeError("boom"))
+
+    with pytest.raises(RuntimeError, match="boom"):
+        await asyncio.wait_for(next_output, timeout=1)
+
+    await asyncio.sleep(0)
+    assert asyncio.all_tasks() == {asyncio.current_task()}
+
+
+@pytest.mark.asyncio
+async def test_create_comfy_client_stops_all_state_trackers(monkeypatch):
+    stopped = []
+
+    class StubStateTracker:
+        def __init__(self, comfy_client):
+            self.comfy_client = comfy_client
+
+        async def stop(self):
+            stopped.append(self)
+            self.comfy_client.state_trackers.remove(self)
+
+    class StubAPIClient:
+        def __init__(self, url, http_client):
+            self.state_trackers = [StubStateTracker(self) for _ in range(3)]
+
+        async def get_index(self):
+            pass
+
+    monkeypatch.setattr(executors, "ComfyAPIClient", StubAPIClient)
+
+    async with executors.create_comfy_client(
+        "http://comfy", start_state_tracker=None
+    ) as comfy_client:
+        state_trackers = list(comfy_client.state_trackers)
+
+    assert stopped == state_trackers
@@ -0,0 +1,182 @@
+import asyncio
+import json
+import math
+
+import httpx
+import pytest
+
+from comfy_executors import utils
+from comfy_executors.executors import RunPodWorkflowExecutor, WorkflowError
+from comfy_executors.workflows import WorkflowTemplate
+
+JOB_ID = "job-1"
+
+WORKFLOW_TEMPLATE = WorkflowTemplate(
+    '{"dir": "{{ input_images_dir }}", "batch_size": {{ batch_size }}}'
+)
+
+
+@pytest.fixture(autouse=True)
+def runpod_api_key(monkeypatch):
+    import runpod
+
+    monkeypatch.setattr(runpod, "api_key", "test-key")
+
+
+@pytest.fixture(autouse=True)
+def no_sleep(monkeypatch):
+    sleep = asyncio.sleep
+    monkeypatch.setattr(asyncio, "sleep", lambda delay: sleep(0))
+
+
+def image_line(name, color=(255, 0, 0), **kwargs):
+    image = utils.create_solid_image((8, 8), color)
+    item = dict(
+        name=name, subfolder="output", image=utils.image_to_b64(image, format="png")
+    )
+    return json.dumps({"images": [item], **kwargs}) + "\n"
+
+
+def create_executor(statuses, streams, requests=None, **executor_kwargs):
+    statuses = iter(statuses)
+    streams = iter(streams)
+
+    def handler(request: httpx.Request):
+        if requests is not None:
+            requests.append(request)
+
+        path = request.url.path
+
+        if path == "/v2/endpoint/run":
+            return httpx.Response(200, json={"id": JOB_ID, "status": "IN_QUEUE"})
+        if path == f"/v2/endpoint/status/{JOB_ID}":
+            status, output = next(statuses)
+            return httpx.Response(200, json={"status": status, "output": output})
+        if path == f"/v2/endpoint/stream/{JOB_ID}":
+            status, chunks = next(streams)
+            stream = [{"output": chunk} for chunk in chunks]
+            return httpx.Response(200, json={"status": status, "stream": stream})
+
+        return httpx.Response(404)
+
+    http_client = httpx.AsyncClient(transport=httpx.MockTransport(handler))
+    return RunPodWorkflowExecutor(
+        "endpoint", http_client=http_client, **executor_kwargs
+    )
+
+
+async def collect(executor, **kwargs):
+    return [
+        output
+        async for output in executor.submit_workflow_async(WORKFLOW_TEMPLATE, **kwargs)
+    ]
+
+
+def test_serialize_payload():
+    payload = {"input": {"seed": 2**64, "cfg": 7.5}}
+    assert json.loads(RunPodWorkflowExecutor._serialize_payload(payload)) == payload
+
+    for payload in [
+        {"input": {"denoise": math.nan}},
+        {"input": {"seed": 2**70, "denoise": math.nan}},
+        {"input": {"workflow": {"3": {"inputs": {"cfg": [math.inf]}}}}},
+    ]:
+        with pytest.raises(ValueError, match="not JSON compliant"):
+            RunPodWorkflowExecutor._serialize_payload(payload)
+
+
+@pytest.mark.asyncio
+async def test_submit_workflow_async():
+    requests = []
+    executor = create_executor(
+        statuses=[
+            ("IN_QUEUE", None),
+            ("IN_QUEUE", None),
+            ("IN_PROGRESS", None),
+            ("COMPLETED", None),
+        ],
+        streams=[
+            ("IN_PROGRESS", [image_line("00.png")[:20]]),
+            ("IN_PROGRESS", [image_line("00.png")[20:], image_line("01.png")]),
+            ("COMPLETED", []),
+        ],
+        requests=requests,
+    )
+
+    outputs = await collect(executor)
+
+    assert [output.name for output in outputs] == ["00.png", "01.png"]
+    assert outputs[0].image.getpixel((0, 0)) == (255, 0, 0)
+    assert all(
+        request.headers["Authorization"] == "Bearer test-key" for request in requests
+    )
+    assert json.loads(requests[0].content)["input"]["workflow"]["batch_size"] == 1
+
+
+@pytest.mark.asyncio
+async def test_submit_workflow_async_input_images():
+    requests = []
+    executor = create_executor(
+        statuses=[("COMPLETED", None), ("COMPLETED", None)],
+        streams=[("COMPLETED", [])],
+        requests=requests,
+        input_image_format="WEBP",
+        input_image_options={"lossless": True},
+    )
+    colors = [(255, 0, 0), (0, 255, 0), (0, 0, 255)]
+    input_images = [utils.create_solid_image((8, 8), color) for color in colors]
+
+    assert await collect(executor, input_images=input_images) == []
+
+    payload = json.loads(requests[0].content)["input"]
+    input_images_dir, job_id = payload["workflow"]["dir"].rsplit("/", 1)
+    assert input_images_dir == "/comfyui/input"
+
+    assert [image_item["name"] for image_item in payload["images"]] == [
+        "00.webp",
+        "01.webp",
+        "02.webp",
+    ]
+
+    for image_item, color in zip(payload["images"], colors):
+        assert image_item["subfolder"] == job_id
+
+        image = utils.image_from_b64(image_item["image"])
+        assert image.format == "WEBP"
+        assert image.convert("RGB").getpixel((0, 0)) == color
+
+
+@pytest.mark.asyncio
+async def test_submit_workflow_async_failed():
+    executor = create_executor(statuses=[("FAILED", "out of memory")], streams=[])
+
+    with pytest.raises(WorkflowError, match="out of memory"):
+        await collect(executor)
+
+
+@pytest.mark.asyncio
+async def test_submit_workflow_async_error_line():
+    def stream_lines():
+        return [image_line("00.png"), json.dumps({"error": "boom"}) + "\n"]
+
+    statuses = [("IN_PROGRESS", None), ("COMPLETED", None)]
+    streams = [("IN_PROGRESS", stream_lines()), ("COMPLETED", [])]
+
+    with pytest.raises(WorkflowError, match="boom"):
+        await collect(create_executor(statuses, streams))
+
+    outputs = await collect(create_executor(statuses, streams), ignore_errors=True)
+    assert [output.name for output in outputs] == ["00.png"]
+
+
+@pytest.mark.asyncio
+async def test_submit_workflow_async_unauthorized():
+    executor = RunPodWorkflowExecutor(
+        "endpoint",
+        http_client=httpx.AsyncClient(
+            transport=httpx.MockTransport(lambda request: httpx.Response(401))
+        ),
+    )
+
+    with pytest.raises(RuntimeError, match="401 Unauthorized"):
+        await collect(executor)
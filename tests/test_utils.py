@@ -0,0 +1,144 @@
+import asyncio
+import os
+import signal
+import threading
+import pytest
+
+from comfy_api_client.utils import replace_noise_seeds as replace_noise_seeds_reference
+
+from comfy_executors import utils
+from comfy_executors.workflows import WorkflowTemplate
+
+
+@pytest.mark.parametrize(
+    "template_file",
+    [
+        "tests/fixtures/workflows/simple.json.jinja",
+        "tests/fixtures/workflows/advanaced.json.jinja",
+    ],
+)
+def test_replace_noise_seeds(template_file):
+    workflow = WorkflowTemplate.from_file(template_file).render(
+        input_images_dir="input/test",
+        batch_size=1,
+        controlnet_template_image_path="input/test.png",
+    )
+
+    noise_seed_paths = utils.find_noise_seed_paths(workflow)
+    assert noise_seed_paths
+
+    expected = replace_noise_seeds_reference(workflow, 42)
+    assert utils.replace_noise_seeds(workflow, 42, noise_seed_paths) == expected
+    assert workflow != expected
+
+
+def test_iterate_in_loop():
+    async def numbers():
+        for i in range(3):
+            await asyncio.sleep(0)
+            yield i
+
+    loop = asyncio.new_event_loop()
+    assert list(utils.iterate_in_loop(numbers(), loop)) == [0, 1, 2]
+
+    thread = threading.Thread(target=loop.run_forever, daemon=True)
+    thread.start()
+    assert list(utils.iterate_in_loop(numbers(), loop)) == [0, 1, 2]
+
+    loop.call_soon_threadsafe(loop.stop)
+    thread.join()
+    loop.close()
+
+
+MERGE_CHUNKS_CASES = [
+    (['{"a": 1}\n', '{"b": 2}\n'], [b'{"a": 1}', b'{"b": 2}']),
+    (['{"a"', ": 1}\n"], [b'{"a": 1}']),
+    (['{"a": 1}\n{"b"', ': 2}\n{"c": 3}\n'], [b'{"a": 1}', b'{"b": 2}', b'{"c": 3}']),
+    ([b'{"a": 1}\n', "\n"], [b'{"a": 1}', b""]),
+]
+
+
+@pytest.mark.parametrize("chunks, expected", MERGE_CHUNKS_CASES)
+def test_merge_chunks(chunks, expected):
+    assert list(utils.merge_chunks(chunks)) == expected
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("chunks, expected", MERGE_CHUNKS_CASES)
+async def test_merge_chunks_async(chunks, expected):
+    async def stream():
+        for chunk in chunks:
+            yield chunk
+
+    assert [line async for line in utils.merge_chunks_async(stream())] == expected
+
+
+def test_merge_chunks_incomplete_line():
+    with pytest.raises(AssertionError):
+        list(utils.merge_chunks(['{"a": 1}\n{"b"']))
+
+
+def test_merge_chunks_long_line(monkeypatch):
+    scanned = 0
+
+    class CountingBuffer(bytearray):
+        def find(self, sub, start=0, *args):
+            nonlocal scanned
+            scanned += len(self) - start
+            return super().find(sub, start, *args)
+
+    monkeypatch.setattr(utils, "bytearray", CountingBuffer, raising=False)
+
+    line = b"x" * (1024 * 1024)
+    chunk_size = 4096
+    chunks = [line[i : i + chunk_size] for i in range(0, len(line), chunk_size)]
+    chunks.append(b"\n")
+
+    assert list(utils.merge_chunks(chunks)) == [line]
+    # The buffered partial line must not be scanned again for every chunk
+    assert scanned <= len(line) + 1
+
+
+def test_glob_images_skips_unreadable_directories(tmp_path, monkeypatch):
+    (tmp_path / "locked").mkdir()
+    (tmp_path / "locked" / "hidden.png").touch()
+    (tmp_path / "nested").mkdir()
+    (tmp_path / "nested" / "b.JPG").touch()
+    (tmp_path / "a.png").touch()
+    (tmp_path / "notes.txt").touch()
+
+    scandir = os.scandir
+
+    def scandir_without_permission(path):
+        if os.path.basename(path) == "locked":
+            raise PermissionError(path)
+        return scandir(path)
+
+    monkeypatch.setattr(os, "scandir", scandir_without_permission)
+
+    assert sorted(utils.glob_images(tmp_path)) == [
+        tmp_path / "a.png",
+        tmp_path / "nested" / "b.JPG",
+    ]
+    assert list(utils.glob_images(tmp_path / "missing")) == []
+
+
+@pytest.mark.skipif(not hasattr(os, "fork"), reason="requires os.fork")
+@pytest.mark.filterwarnings("ignore::DeprecationWarning")
+def test_thread_pool_after_fork():
+    images = [utils.create_solid_image((8, 8), (0, 0, 0))] * 4
+
+    # Start the pool's worker threads before forking
+    assert len(utils.images_to_b64(images)) == 4
+
+    pid = os.fork()
+
+    if pid == 0:
+        signal.alarm(5)
+        try:
+            os._exit(0 if len(utils.images_to_b64(images)) == 4 else 1)
+        except BaseException:
+            os._exit(1)
+
+    _, status = os.waitpid(pid, 0)
+    assert os.waitstatus_to_exitcode(status) == 0
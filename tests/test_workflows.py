@@ -0,0 +1,48 @@
+import os
+import pytest
+
+from comfy_executors.workflows import WorkflowTemplate
+
+
+def test_missing_required_variables():
+    with pytest.raises(ValueError, match="input_images_dir"):
+        WorkflowTemplate('{"batch_size": {{ batch_size }}, "text": "{{ prompt }}"}')
+
+
+def test_from_file_cached(tmp_path):
+    template_file = tmp_path / "workflow.json.jinja"
+    template_file.write_text('["{{ input_images_dir }}", {{ batch_size }}]')
+
+    workflow_template = WorkflowTemplate.from_file(template_file)
+    assert WorkflowTemplate.from_file(template_file) is workflow_template
+
+    template_file.write_text('["{{ input_images_dir }}", {{ batch_size }}, 1]')
+    os.utime(template_file, ns=(0, 0))
+
+    updated_template = WorkflowTemplate.from_file(template_file)
+    assert updated_template is not workflow_template
+    assert updated_template.render(input_images_dir="input", batch_size=1) == [
+        "input",
+        1,
+        1,
+    ]
+
+    # Same timestamp, different size
+    template_file.write_text('["{{ input_images_dir }}", {{ batch_size }}, 22]')
+    os.utime(template_file, ns=(0, 0))
+
+    assert WorkflowTemplate.from_file(template_file).render(
+        input_images_dir="input", batch_size=1
+    ) == ["input", 1, 22]
+
+
+def test_render_keeps_numeric_types():
+    workflow_template = WorkflowTemplate(
+        '{"dir": "{{ input_images_dir }}", "batch_size": {{ batch_size }}, "cfg": {{ cfg }}}'
+    )
+
+    workflow = workflow_template.render(input_images_dir="in", batch_size=1, cfg=1.0)
+    assert isinstance(workflow["cfg"], float)
+
+    workflow = workflow_template.render(input_images_dir="in", batch_size=1, cfg=1)
+    assert isinstance(workflow["cfg"], int)